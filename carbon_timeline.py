@@ -1,210 +1,316 @@
 """A tool to compute CO2 emissions from Google Maps Timeline export."""
 
 import argparse
-import collections
+import array
+import concurrent.futures
 import datetime
-import json
-import math
-import pathlib
-import tempfile
+import itertools
+import re
+import sys
 import zipfile
 
-import dateutil
-from dateutil import relativedelta, parser
+import numba
+import numpy as np
 
+try:
+  import orjson as json
+except ImportError:
+  import json
+try:
+  from ciso8601 import parse_rfc3339 as parse_iso_timestamp
+except ImportError:
+
+  def parse_iso_timestamp(timestamp):
+    # Before Python 3.11, fromisoformat does not accept the "Z" suffix.
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+# Emission factors are in g.co2.eq per km, to keep the computations in
+# integers.
 # We're only counting here the emissions from the fuel burnt, not including
 # the car manufacturing.
 # https://www.eea.europa.eu/data-and-maps/indicators/average-co2-emissions-from-motor-vehicles-1/assessment
-ROAD_KG_CO2_PER_KM = 0.120
+ROAD_G_CO2_PER_KM = 120
 # https://www.eea.europa.eu/publications/ENVISSUENo12/page029.html
-CAR_OCCUPANCY = 1.5
+# 1.5 passengers, in tenths of a passenger.
+CAR_OCCUPANCY_TENTHS = 15
 # https://ourworldindata.org/travel-carbon-footprint
-AIR_KG_CO2_PER_KM = 0.156
+AIR_G_CO2_PER_KM = 156
 # https://ourworldindata.org/travel-carbon-footprint
 # I mainly use electrified trains in western europe, should be increased if
 # you use non electrified trains
-RAIL_KG_CO2_PER_KM = 0.006
+RAIL_G_CO2_PER_KM = 6
 
+# Monthly files of the Semantic Location History, like
+# "Semantic Location History/2020/2020_JANUARY.json". Other JSON files of the
+# export don't contain timelineObjects. The folder name may be localized.
+MONTHS = ("JANUARY", "FEBRUARY", "MARCH", "APRIL", "MAY", "JUNE", "JULY",
+          "AUGUST", "SEPTEMBER", "OCTOBER", "NOVEMBER", "DECEMBER")
+TIMELINE_FILE = re.compile(r"/(\d{4})/\1_(%s)\.json$" % "|".join(MONTHS))
 
-class CarbonTimeline:
-  """Main class."""
+# Transportation codes, stored as int8 in the activity arrays.
+AIR = 0
+ROAD = 1
+RAIL = 2
+TRANSPORTATIONS = ("AIR", "ROAD", "RAIL")
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MILLISECOND = datetime.timedelta(milliseconds=1)
+# From an activity like IN_TRAIN to a transportation code, None if carbon
+# neutral.
+ACTIVITY_TYPES = {
+    "FLYING": AIR,
+    "IN_TAXI": ROAD,
+    "IN_PASSENGER_VEHICLE": ROAD,
+    "IN_VEHICLE": ROAD,
+    "IN_TRAIN": RAIL,
+    "IN_TRAM": RAIL,
+}
+
+
+def _parse_one(member):
+  """Extracts the activities of one JSON file of the takeout export.
+
+  Runs in a worker process, so it opens its own handle on the archive.
+
+  Args:
+    member: a (takeout_file, json_file) tuple.
+
+  Returns:
+    A (ts_ms, distance_km, type_code) tuple of array.array, unsorted.
+  """
+  takeout_file, json_file = member
+  ts_ms = array.array("q")
+  distance_km = array.array("i")
+  type_code = array.array("b")
+  with zipfile.ZipFile(takeout_file) as takeout:
+    with takeout.open(json_file) as f:
+      json_dict = json.loads(f.read())
+  # JSON is like
+  # {"timelineObjects" :
+  #   [{"activitySegment" : "a"}, {"activitySegment" : "b"}, {"other": "c"}]}
+  # we just need the activity segments.
+  if "timelineObjects" not in json_dict:
+    return ts_ms, distance_km, type_code
+  for my_dict in json_dict["timelineObjects"]:
+    segment = my_dict.get("activitySegment")
+    if segment is None:
+      continue
+    distance = segment.get("distance")
+    activity = segment.get("activityType")
+    if distance is None or activity is None:
+      continue
+    code = ACTIVITY_TYPES.get(activity)
+    if code is None:
+      # Carbon neutral.
+      continue
+    ts_ms.append(_timestamp_ms(segment["duration"]))
+    distance_km.append(int(distance // 1000))
+    type_code.append(code)
+  return ts_ms, distance_km, type_code
+
+
+def _timestamp_ms(duration):
+  """Returns the start of an activity duration in milliseconds since epoch.
+
+  Depending on when it was exported, the start is either an epoch in ms like
+  "1643717372412" or an RFC 3339 string like "2022-02-01T12:09:32.412Z".
+  """
+  ts = duration.get("startTimestampMs")
+  if ts is not None:
+    return ts if type(ts) is int else int(ts)
+  ts = parse_iso_timestamp(duration["startTimestamp"])
+  return (ts - EPOCH) // MILLISECOND
+
+
+@numba.njit(cache=True)
+def _kg_co2(distance, type_code):
+  """Computes the kg.co2.eq cost of a trip.
+
+  Args:
+    distance: in km.
+    type_code: transportation code like ROAD, AIR, RAIL.
+
+  Returns:
+    carbon footpring in kg.co2.eq, rounded down.
+  """
+  if type_code == ROAD:
+    return (distance * ROAD_G_CO2_PER_KM * 10) // (
+        1000 * CAR_OCCUPANCY_TENTHS)
+  if type_code == AIR:
+    return (distance * AIR_G_CO2_PER_KM) // 1000
+  if type_code == RAIL:
+    return (distance * RAIL_G_CO2_PER_KM) // 1000
+  return 0
+
+
+@numba.njit(cache=True)
+def _aggregate(buckets, distance_km, type_code, n_buckets):
+  """Sums up distances and carbon footprints per transportation and bucket.
+
+  Args:
+    buckets: bucket index of each activity.
+    distance_km: distance of each activity in km.
+    type_code: transportation code of each activity.
+    n_buckets: number of buckets.
 
-  def __init__(self, takeout_file, resolution, debug):
-    temp_dir = tempfile.TemporaryDirectory()
+  Returns:
+    A (km, co2) tuple of (transportation, bucket) arrays.
+  """
+  km = np.zeros((len(TRANSPORTATIONS), n_buckets), np.int64)
+  for i in range(buckets.size):
+    km[type_code[i], buckets[i]] += distance_km[i]
+  # Compute carbon footprint for each bucket while the sums are hot.
+  co2 = np.empty_like(km)
+  for code in range(km.shape[0]):
+    for bucket in range(n_buckets):
+      co2[code, bucket] = _kg_co2(km[code, bucket], code)
+  return km, co2
 
-    file = zipfile.ZipFile(takeout_file)
-    file.extractall(path=temp_dir.name)
 
-    p = pathlib.Path(temp_dir.name)
-    json_files = list(p.glob("**/*.json"))
-    # json_files = list(p.glob("**/2019_*.json"))
-    clean_activities = self.extract_activities(json_files)
+class CarbonTimeline:
+  """Main class."""
+
+  def __init__(self, takeout_file, resolution, debug, since=None, until=None):
+    with zipfile.ZipFile(takeout_file) as takeout:
+      # Read the JSON files straight from the archive, without extracting it.
+      json_files = self.list_json_files(takeout.namelist(), since, until)
+    clean_activities = self.extract_activities(takeout_file, json_files)
     if debug:
       self.print_csv_activities(clean_activities)
     else:
       bucketized_activities = self.bucketize(clean_activities, resolution)
       self.print_csv_bucketized_activities(bucketized_activities)
-    temp_dir.cleanup()
 
-  def extract_activities(self, json_files):
-    """From timelineObjects, extracts activities objects, convert them.
+  def list_json_files(self, names, since, until):
+    """Lists the monthly timeline files, in chronological order.
 
     Args:
-      json_files: path to the files, one per month.
+      names: names of all the files in the takeout export.
+      since: first month to keep as a month index like parse_month returns, or
+        None.
+      until: last month to keep as a month index, or None.
 
     Returns:
-      A list of clean activities, with only the fields we need to compute co2.
+      The names of the files to read.
     """
-    # JSON is like
-    # {"timelineObjects" :
-    #   [{"activitySegment" : "a"}, {"activitySegment" : "b"}, {"other": "c"}]}
-    # we just need the activity segments.
-    activities = []
-    for json_file in json_files:
-      with json_file.open() as f:
-        json_dict = json.loads(f.read())
-        if "timelineObjects" in json_dict:
-          json_list = json_dict["timelineObjects"]
-          for my_dict in json_list:
-            if "activitySegment" in my_dict:
-              clean = self.clean_fields(my_dict)
-              if clean is not None:
-                activities.append(clean)
-    activities.sort(key=lambda x: x["ts"])
-    return activities
-
-  def print_csv_activities(self, clean_activities):
-    """Useful for debugging."""
+    months = {}
+    for name in names:
+      match = TIMELINE_FILE.search(name)
+      if match is None:
+        continue
+      month = int(match.group(1)) * 12 + MONTHS.index(match.group(2))
+      if since is not None and month < since:
+        continue
+      if until is not None and month > until:
+        continue
+      months[name] = month
+    return sorted(months, key=months.get)
 
-    print("ts, type, distance")
-    for i in clean_activities:
-      print("%s, %s, %s" %
-            (i["ts"], i["type"], i["distance"]))
+  def extract_activities(self, takeout_file, json_files):
+    """From timelineObjects, extracts activities objects, convert them.
 
-  def clean_fields(self, activity_segment):
-    """Converts activity_segment to something usable.
+    Files are parsed in parallel, one process per core.
 
     Args:
-      activity_segment: dict as found in json.
+      takeout_file: path to the takeout export file.
+      json_files: names of the files in the archive, one per month, in
+        chronological order.
 
     Returns:
-      A cleaner dict like
-      {
-        ts: timestamp as a datetime object like "2022-02-01T12:09:32.412Z"
-        distance: distance in km
-        type: activity like AIR, RAIL, ROAD
-      },
-      None if carbon neutral,
+      A (ts_ms, distance_km, type_code) tuple of parallel numpy arrays sorted by
+      timestamp, with only the fields we need to compute co2.
     """
-    clean = {}
-    clean["ts"] = dateutil.parser.parse(activity_segment["activitySegment"]["duration"]["startTimestamp"])
-    if "distance" not in activity_segment["activitySegment"]:
-      return None
-    clean["distance"] = activity_segment["activitySegment"]["distance"] // 1000
-    if "activityType" not in activity_segment["activitySegment"]:
-      return None
-    clean["type"] = self.categorize_activity(
-        activity_segment["activitySegment"]["activityType"])
-    if clean["type"] is None:
-      return None
-    return clean
-
-  def print_timestamp(self, timestamp, resolution):
-    if resolution == "MONTH":
-      return timestamp.strftime("%Y-%m")
-    if resolution == "YEAR":
-      return timestamp.strftime("%Y")
-    if resolution == "SECOND":
-      return timestamp.strftime("%Y-%m-%d %H:%M:%S%z")
-
-  def categorize_activity(self, activity):
-    """From an activity like IN_TRAIN, returns AIR, ROAD, RAIL or None."""
-    if activity == "FLYING":
-      return "AIR"
-    if activity in ["IN_TAXI", "IN_PASSENGER_VEHICLE", "IN_VEHICLE"]:
-      return "ROAD"
-    if activity in ["IN_TRAIN", "IN_TRAM"]:
-      return "RAIL"
-    return None
+    ts_ms = array.array("q")
+    distance_km = array.array("i")
+    type_code = array.array("b")
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+      members = [(takeout_file, json_file) for json_file in json_files]
+      for file_ts_ms, file_distance_km, file_type_code in executor.map(
+          _parse_one, members, chunksize=4):
+        ts_ms.extend(file_ts_ms)
+        distance_km.extend(file_distance_km)
+        type_code.extend(file_type_code)
+    ts_ms = np.asarray(ts_ms, dtype=np.int64)
+    distance_km = np.asarray(distance_km, dtype=np.int32)
+    type_code = np.asarray(type_code, dtype=np.int8)
+    # Files are read in chronological order, so activities usually are
+    # already sorted.
+    if np.any(ts_ms[1:] < ts_ms[:-1]):
+      order = np.argsort(ts_ms, kind="stable")
+      return ts_ms[order], distance_km[order], type_code[order]
+    return ts_ms, distance_km, type_code
+
+  def print_csv_activities(self, clean_activities):
+    """Useful for debugging."""
+
+    ts_ms, distance_km, type_code = clean_activities
+    # Format all timestamps at once rather than one datetime per activity.
+    timestamps = np.datetime_as_string(
+        ts_ms.astype("datetime64[ms]"), timezone="UTC")
+    rows = zip(timestamps.tolist(),
+               [TRANSPORTATIONS[code] for code in type_code.tolist()],
+               distance_km.tolist())
+    self.write_csv(("ts", "type", "distance"), rows)
 
   def bucketize(self, clean_activities, resolution):
     """Sum up kilometers and co2 emissions over a bucket of size resolution.
 
     Args:
-      clean_activities: a list like [{ts, distance, type}, {...}].
+      clean_activities: a (ts_ms, distance_km, type_code) tuple of arrays, as
+        returned by extract_activities.
       resolution: MONTH or YEAR.
 
     Returns:
-      An OrderedDict like
-      {"2021-08": {air_km: 1000, road_km: 100, rail_km: 10,
-      air_co2:, road_co2:, rail_co2: }}
+      A (labels, km, co2) tuple where
+        labels: bucket names like "2021-08", empty buckets included
+        km: (transportation, bucket) array of distances
+        co2: (transportation, bucket) array of carbon footprints in kg.co2.eq
     """
-    results = collections.OrderedDict()
-    current = clean_activities[0]["ts"].replace(
-        day=1, hour=0, minute=0, second=0, microsecond=0)
-    if resolution == "YEAR":
-      current = clean_activities[0]["ts"].replace(
-          day=1, month=1, hour=0, minute=0, second=0, microsecond=0)
-    last_timestamp = clean_activities[-1]["ts"]
-    # Create empty entries for all months/years.
-    while current < last_timestamp:
-      results[self.print_timestamp(current, resolution)] = {
-          "air_km": 0,
-          "road_km": 0,
-          "rail_km": 0,
-          "air_co2": 0,
-          "road_co2": 0,
-          "rail_co2": 0
-      }
-      if resolution == "MONTH":
-        current += dateutil.relativedelta.relativedelta(months=1)
-      else:
-        current += dateutil.relativedelta.relativedelta(years=1)
-
-    # Sum up the distances in the right categories.
-    for act in clean_activities:
-      short = self.print_timestamp(act["ts"], resolution)
-      result = results[short]
-      if act["type"] == "AIR":
-        result["air_km"] = result["air_km"] + act["distance"]
-      if act["type"] == "ROAD":
-        result["road_km"] = result["road_km"] + act["distance"]
-      if act["type"] == "RAIL":
-        result["rail_km"] = result["rail_km"] + act["distance"]
-      results[short] = result
-
-    # Compute carbon footprint for each bucket.
-    for unused_key, value in results.items():
-      value["air_co2"] = self.kg_co2(value["air_km"], "AIR")
-      value["road_co2"] = self.kg_co2(value["road_km"], "ROAD")
-      value["rail_co2"] = self.kg_co2(value["rail_km"], "RAIL")
-    return results
+    ts_ms, distance_km, type_code = clean_activities
+    if ts_ms.size == 0:
+      empty = np.zeros((len(TRANSPORTATIONS), 0), np.int64)
+      return np.array([], dtype=str), empty, empty.copy()
+    # Bucket index of each activity, in months (or years) since 1970.
+    unit = "M" if resolution == "MONTH" else "Y"
+    buckets = ts_ms.astype("datetime64[ms]").astype(
+        "datetime64[%s]" % unit).astype(np.int64)
+    first_bucket = buckets[0]
+    buckets -= first_bucket
+    n_buckets = buckets[-1] + 1
+    # Create entries for all months/years, including empty ones.
+    labels = np.datetime_as_string(
+        np.arange(first_bucket, first_bucket + n_buckets).astype(
+            "datetime64[%s]" % unit))
+
+    # Sum up the distances in the right categories, and their carbon
+    # footprint.
+    km, co2 = _aggregate(buckets, distance_km, type_code, n_buckets)
+    return labels, km, co2
 
   def print_csv_bucketized_activities(self, bucketized_activities):
-    print("date, air_km, road_km, rail_km, air_co2, road_co2, rail_co2")
-    for key, value in bucketized_activities.items():
-      print("%s, %s, %s, %s, %s, %s, %s" %
-            (key, value["air_km"], value["road_km"], value["rail_km"],
-             value["air_co2"], value["road_co2"], value["rail_co2"]))
+    labels, km, co2 = bucketized_activities
+    rows = zip(labels.tolist(), *km.tolist(), *co2.tolist())
+    self.write_csv(("date", "air_km", "road_km", "rail_km", "air_co2",
+                    "road_co2", "rail_co2"), rows)
 
-  def kg_co2(self, distance, transportation):
-    """Computes the kg.co2.eq cost of a trip.
+  def write_csv(self, header, rows):
+    """Writes header and rows to stdout in one go, rather than a print per row.
 
     Args:
-      distance: in km.
-      transportation: like ROAD, AIR, RAIL.
-
-    Returns:
-      carbon footpring in kg.co2.eq
+      header: tuple of column names.
+      rows: iterable of tuples, one per line.
     """
-    co2 = 0
-    if transportation == "ROAD":
-      co2 = (distance * ROAD_KG_CO2_PER_KM) / CAR_OCCUPANCY
-    if transportation == "AIR":
-      co2 = distance * AIR_KG_CO2_PER_KM
-    if transportation == "RAIL":
-      co2 = distance * RAIL_KG_CO2_PER_KM
-    return math.floor(co2)
+    sys.stdout.write(
+        "".join([", ".join(map(str, row)) + "\n"
+                 for row in itertools.chain((header,), rows)]))
+    sys.stdout.flush()
+
+
+def parse_month(value):
+  """From a month like 2019-01, returns its index year * 12 + month - 1."""
+  match = re.fullmatch(r"(\d{4})-(\d{2})", value)
+  if match is None or not 1 <= int(match.group(2)) <= 12:
+    raise argparse.ArgumentTypeError("expected a month like 2019-01")
+  return int(match.group(1)) * 12 + int(match.group(2)) - 1
 
 
 def main():
@@ -219,8 +325,20 @@ def main():
       "--debug",
       help="Print all clean trips with timestamp, useful to identify weird data",
       action=argparse.BooleanOptionalAction)
+  parser.add_argument(
+      "--since",
+      type=parse_month,
+      help="First month to read, like 2019-01")
+  parser.add_argument(
+      "--until",
+      type=parse_month,
+      help="Last month to read, like 2019-12")
   args = parser.parse_args()
-  CarbonTimeline(args.takeout_file, args.resolution, args.debug)
+  if (args.since is not None and args.until is not None and
+      args.since > args.until):
+    parser.error("--since must not be after --until")
+  CarbonTimeline(args.takeout_file, args.resolution, args.debug, args.since,
+                 args.until)
 
 
 if __name__ == "__main__":